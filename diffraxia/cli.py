@@ -4,8 +4,8 @@ Command-line interface for Diffraxia.
 
 import argparse
 
-from .eiger import eiger_to_tiff
-from .integrate import integrate_tiff_folder
+from .eiger import eiger_to_h5, eiger_to_tiff
+from .integrate import OUTPUT_FORMATS, integrate_h5_stack, integrate_tiff_folder
 
 
 def main():
@@ -41,6 +41,46 @@ def main():
         default=None,
         help="Optional limit on number of frames to convert",
     )
+    p_eiger.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of decoding threads (default: number of CPUs)",
+    )
+
+    # Subcommand: eiger2h5
+    p_stack = subparsers.add_parser(
+        "eiger2h5",
+        help="Convert Eiger HDF5 file to a single 3D frame stack (HDF5).",
+    )
+    p_stack.add_argument("h5file", help="Path to Eiger .h5 file")
+    p_stack.add_argument(
+        "-g",
+        "--group",
+        default="data",
+        help="Top-level HDF5 group containing frames (default: data)",
+    )
+    p_stack.add_argument(
+        "-o",
+        "--output",
+        default="frames.h5",
+        help="Output HDF5 file for the frame stack (default: frames.h5)",
+    )
+    p_stack.add_argument(
+        "-n",
+        "--nframes",
+        type=int,
+        default=None,
+        help="Optional limit on number of frames to convert",
+    )
+    p_stack.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of decoding threads (default: number of CPUs)",
+    )
 
     # Subcommand: integrate
     p_int = subparsers.add_parser(
@@ -52,11 +92,20 @@ def main():
         required=True,
         help="Calibrated .hexrd instrument file",
     )
-    p_int.add_argument(
+    p_input = p_int.add_mutually_exclusive_group(required=True)
+    p_input.add_argument(
         "--tiff-folder",
-        required=True,
         help="Folder containing TIFF images",
     )
+    p_input.add_argument(
+        "--input-h5",
+        help="HDF5 frame stack written by eiger2h5 (instead of --tiff-folder)",
+    )
+    p_int.add_argument(
+        "--dataset",
+        default="data",
+        help="3D dataset holding the frames in --input-h5 (default: data)",
+    )
     p_int.add_argument(
         "--pattern",
         default="*.tiff,*.tif",
@@ -83,7 +132,32 @@ def main():
     p_int.add_argument(
         "--output-prefix",
         required=True,
-        help="Prefix for per-file output text files",
+        help="Prefix for output files",
+    )
+    p_int.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default="txt",
+        help=(
+            "txt: one text file per frame; h5/npy: all frames in a single "
+            "<prefix>.h5 or <prefix>_I_sum.npy (default: txt)"
+        ),
+    )
+    p_int.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of worker processes (default: 1). Each worker holds "
+            "one batch of frames in memory"
+        ),
+    )
+    p_int.add_argument(
+        "--batch-size",
+        type=int,
+        default=16,
+        help="Number of frames integrated per batch (default: 16)",
     )
 
     args = parser.parse_args()
@@ -94,6 +168,28 @@ def main():
             group_name=args.group,
             output_folder=args.output_folder,
             nframes=args.nframes,
+            workers=args.workers,
+        )
+    elif args.command == "eiger2h5":
+        eiger_to_h5(
+            h5_path=args.h5file,
+            output_path=args.output,
+            group_name=args.group,
+            nframes=args.nframes,
+            workers=args.workers,
+        )
+    elif args.command == "integrate" and args.input_h5:
+        integrate_h5_stack(
+            instr_file=args.instrument,
+            h5_path=args.input_h5,
+            dataset=args.dataset,
+            tth_min=args.tth_min,
+            tth_max=args.tth_max,
+            nbins=args.nbins,
+            output_prefix=args.output_prefix,
+            batch_size=args.batch_size,
+            output_format=args.output_format,
+            workers=args.workers,
         )
     elif args.command == "integrate":
         integrate_tiff_folder(
@@ -104,6 +200,9 @@ def main():
             nbins=args.nbins,
             pattern=args.pattern,
             output_prefix=args.output_prefix,
+            batch_size=args.batch_size,
+            output_format=args.output_format,
+            workers=args.workers,
         )
     else:
         parser.print_help()
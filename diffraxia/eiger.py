@@ -1,5 +1,5 @@
 """
-Helpers for converting Eiger HDF5 files to TIFF.
+Helpers for converting Eiger HDF5 files to TIFF (or to a single HDF5 frame stack).
 
 This module is tailored for CHESS-style Eiger outputs and currently supports
 two on-disk layout variants under the top-level ``/data`` group:
@@ -23,13 +23,17 @@ which is consistent with typical CHESS EIG16M_CdTe configurations.
 
 from __future__ import annotations
 
+import functools
+import itertools
 import os
-from typing import Iterable, Optional
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, Iterator, Optional
 
 import h5py
-import imageio.v3 as iio
 import numpy as np
+import tifffile
 from dectris.compression import decompress
+from numba import njit
 
 
 # ---------------------------------------------------------------------------
@@ -38,6 +42,13 @@ from dectris.compression import decompress
 
 _REQUIRED_KEYS = ["data", "shape", "dtype", "elem_size", "compression_type"]
 
+# Use a fixed uint32 representation for the Eiger bitstream.
+_FRAME_DTYPE = np.dtype("uint32")
+
+# Buffer size for TIFF output files. Coalesces tifffile's many small header
+# and IFD writes into few syscalls, which matters on network file systems.
+_TIFF_WRITE_BUFFER = 1024 * 1024
+
 
 def _has_required_keys(group: h5py.Group) -> bool:
     """
@@ -108,76 +119,320 @@ def _read_shape(shape_ds) -> tuple[int, int]:
     """
     Read the 'shape' dataset as a (ny, nx) tuple of ints.
     """
-    arr = shape_ds[()]
-    arr = np.atleast_1d(arr)
-    return tuple(int(x) for x in arr)
+    value = shape_ds[()]
+    # tolist() converts to Python scalars in one call; int() still
+    # coerces shapes stored as floats, as np.empty/reshape need ints
+    if getattr(value, "ndim", 0):
+        return tuple(int(x) for x in value.tolist())
+    return (int(value),)
 
 
-def list_frame_keys(group: h5py.Group) -> Iterable[str]:
+def _read_raw(data_ds: h5py.Dataset, buf: Optional[np.ndarray] = None) -> tuple:
     """
-    Return sorted frame keys under a /data group.
+    Read the compressed payload of a frame into a reusable uint8 buffer.
 
-    Eiger typically uses integer-like names ("0", "1", "2", ...),
-    so we sort them numerically.
+    The payload is read with ``read_direct`` so h5py does not allocate a
+    fresh array per frame. ``buf`` is replaced by a larger allocation if it
+    cannot hold the payload. Returns ``(buf, raw)`` where ``raw`` is the
+    uint8 view of ``buf`` holding exactly the bytes that were read.
     """
-    return sorted(group.keys(), key=lambda k: int(k))
+    nbytes = data_ds.size * data_ds.dtype.itemsize
+    if buf is None or buf.size < nbytes:
+        buf = np.empty(nbytes, dtype=np.uint8)
+    raw = buf[:nbytes]
+    # Eiger stores each compressed frame as a scalar opaque (|V<n>) dataset;
+    # viewing the byte buffer with the dataset dtype lets HDF5 fill it as is.
+    data_ds.read_direct(raw.view(data_ds.dtype).reshape(data_ds.shape))
+    return buf, raw
 
 
-# ---------------------------------------------------------------------------
-# Public API
-# ---------------------------------------------------------------------------
+def _read_frame_metadata(payload: h5py.Group) -> tuple:
+    """
+    Read the ``(dtype_meta, elem_size, compression_type)`` scalars of a
+    payload group.
+    """
+    dtype_meta = _read_scalar(payload["dtype"])
+    elem_size = int(_read_scalar(payload["elem_size"]))
+    compression_type = _read_scalar(payload["compression_type"])
+    return dtype_meta, elem_size, compression_type
+
 
-def get_frame_array(frame_group: h5py.Group) -> np.ndarray:
+def _read_run_metadata(payloads: list) -> tuple:
     """
-    Decode a single Eiger frame into a 2D NumPy array.
+    Read the frame metadata of a run once and return ``(shape, decoder)``.
 
-    The function automatically supports both:
-      * multi-channel layout: /data/<i>/difference/...
-      * flattened layout:     /data/<i>/{data, shape, dtype, ...}
+    Instead of reading ``shape``/``dtype``/``elem_size``/``compression_type``
+    for every frame, they are read from the first frame and checked against
+    the last one, which catches files whose frames were recorded with
+    different settings.
+    """
+    first = (_read_shape(payloads[0]["shape"]),) + _read_frame_metadata(payloads[0])
+    last = (_read_shape(payloads[-1]["shape"]),) + _read_frame_metadata(payloads[-1])
+    if first != last:
+        raise RuntimeError(
+            "Eiger frames have inconsistent metadata. "
+            "(shape, dtype, elem_size, compression_type) of the first frame: "
+            f"{first}, of the last frame: {last}."
+        )
 
-    Notes
-    -----
-    * We use a fixed NumPy dtype of uint32 for the decoded array, which
-      matches the typical Eiger bitstream (often reported as ``"<u4"``).
-    * The 'dtype' and 'elem_size' fields from the file are used only for
-      sanity checks and diagnostics, not for choosing the NumPy dtype.
+    shape, dtype_meta, elem_size, compression_type = first
+    return shape, _make_decoder(dtype_meta, elem_size, compression_type)
+
+
+def _read_frame_payload(
+    frame_group: h5py.Group,
+    raw_buf: Optional[np.ndarray] = None,
+) -> tuple:
+    """
+    Read the compressed data and metadata of a single Eiger frame.
+
+    Returns ``(raw_buf, frame)``, where ``raw_buf`` is the (possibly
+    reallocated) buffer from :func:`_read_raw` and ``frame`` is a tuple
+    ``(raw, shape, decoder)`` that can be handed to :func:`_decode_frame`.
+    HDF5 access is kept in this helper so that decoding can run on worker
+    threads without touching the file.
     """
     payload = _select_payload_group(frame_group)
 
-    # Read metadata and compressed data
-    raw_data = payload["data"][()]
+    raw_buf, raw = _read_raw(payload["data"], raw_buf)
     shape = _read_shape(payload["shape"])
-    dtype_meta = _read_scalar(payload["dtype"])
-    elem_size = int(_read_scalar(payload["elem_size"]))
-    compression_type = _read_scalar(payload["compression_type"])
+    decoder = _make_decoder(*_read_frame_metadata(payload))
+    return raw_buf, (raw, shape, decoder)
+
 
-    # Use a fixed uint32 representation for the Eiger bitstream.
-    dtype_np = np.dtype("uint32")
+def _make_decoder(
+    dtype_meta: object,
+    elem_size: int,
+    compression_type: str,
+) -> Callable[..., bytes]:
+    """
+    Validate the frame metadata and bind it into a decompressor.
 
+    The metadata is constant for a whole Eiger run, so the returned
+    callable only takes the raw data buffer and can be reused per frame.
+    """
     # Light sanity check: elem_size should match uint32 size.
-    if elem_size != dtype_np.itemsize:
+    if elem_size != _FRAME_DTYPE.itemsize:
         raise RuntimeError(
             "Inconsistent Eiger frame metadata: elem_size does not match uint32. "
-            f"elem_size={elem_size} byte(s), expected={dtype_np.itemsize}. "
+            f"elem_size={elem_size} byte(s), expected={_FRAME_DTYPE.itemsize}. "
             f"Reported dtype in file: {dtype_meta!r}"
         )
 
+    return functools.partial(decompress, algorithm=compression_type, elem_size=elem_size)
+
+
+def _decode_frame(
+    raw_data,
+    shape: tuple[int, int],
+    decoder: Callable[..., bytes],
+    out: Optional[np.ndarray] = None,
+    mask_saturation: bool = False,
+) -> np.ndarray:
+    """
+    Decompress a raw Eiger frame buffer into a writable 2D uint32 array.
+
+    ``decoder`` comes from :func:`_make_decoder`. If ``out`` is a uint32
+    array of the right shape, the decoded frame is copied into it and it
+    is returned; otherwise a new array is allocated. With
+    ``mask_saturation``, saturated pixels are zeroed during that copy.
+    """
     # Decompress the raw data buffer
-    buf = decompress(raw_data, compression_type, elem_size=elem_size)
+    buf = decoder(raw_data)
 
     # Validate decompressed size
-    expected_nbytes = int(np.prod(shape)) * dtype_np.itemsize
+    expected_nbytes = int(np.prod(shape)) * _FRAME_DTYPE.itemsize
     if len(buf) != expected_nbytes:
         raise RuntimeError(
             "Decompressed Eiger frame has unexpected size. "
             f"len(buf)={len(buf)}, expected={expected_nbytes} for "
-            f"shape={shape} and dtype={dtype_np}."
+            f"shape={shape} and dtype={_FRAME_DTYPE}."
         )
 
-    # Interpret the buffer as a 2D uint32 array
-    arr = np.frombuffer(buf, dtype=dtype_np).reshape(shape)
+    # Interpret the buffer as a 2D uint32 array. np.frombuffer returns a
+    # read-only view of the bytes object, so copy it into a writable array
+    # that callers can modify in place.
+    if out is None or out.shape != shape or out.dtype != _FRAME_DTYPE:
+        out = np.empty(shape, dtype=_FRAME_DTYPE)
+    src = np.frombuffer(buf, dtype=_FRAME_DTYPE)
+    if mask_saturation:
+        _mask_saturation(src, out.reshape(-1))
+    else:
+        np.copyto(out, src.reshape(shape))
+    return out
+
+
+@njit(cache=True, nogil=True)
+def _mask_saturation(src, out):
+    """
+    Copy ``src`` into ``out``, replacing saturation sentinels (max of uint32) with 0.
+
+    This avoids huge spikes in downstream integration. Copy and mask are
+    fused into a single pass over the frame; ``out`` may be ``src`` itself
+    to mask in place. Both arrays are flat. The kernel releases the GIL so
+    that pipeline workers can run it concurrently.
+    """
+    sentinel = np.uint32(0xFFFFFFFF)
+    for i in range(src.size):
+        v = src[i]
+        out[i] = 0 if v == sentinel else v
+
+
+def _decode_and_mask(frame: tuple, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Worker-side stage of the conversion pipeline: decode and mask a frame.
+    """
+    return _decode_frame(*frame, out=out, mask_saturation=True)
+
+
+def _drop_page_cache(fh) -> None:
+    """
+    Hint the OS that the pages of a just-written file will not be reused.
+
+    Output TIFFs are write-once, so keeping them in the page cache only
+    pushes out more useful data. POSIX_FADV_DONTNEED skips dirty pages, so
+    the data is synced to disk first. This is a best-effort hint: it is a
+    no-op on platforms without ``os.posix_fadvise`` (Windows, macOS), and
+    OS errors are ignored.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fh.flush()
+        os.fdatasync(fh.fileno())
+        os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+
+
+def list_frame_keys(group: h5py.Group) -> Iterable[str]:
+    """
+    Return sorted frame keys under a /data group.
+
+    Eiger typically uses integer-like names ("0", "1", "2", ...),
+    so we sort them numerically.
+    """
+    return sorted(group.keys(), key=lambda k: int(k))
+
+
+def _iter_decoded_frames(
+    h5_path: str,
+    group_name: str,
+    nframes: Optional[int],
+    workers: Optional[int],
+) -> Iterator[tuple[int, int, np.ndarray]]:
+    """
+    Decode the frames of an Eiger file, yielding ``(idx, count, img)`` in
+    frame order, where ``count`` is the total number of frames.
+
+    Frames are processed as a three-stage pipeline: the calling thread reads
+    compressed frames from the HDF5 file, a pool of ``workers`` threads
+    decompresses them and masks saturated pixels, and the decoded frames
+    are yielded back in order. At most ``2 * workers`` frames are held in
+    memory. ``img`` is a recycled buffer: it is only valid until the next
+    frame is requested.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError(f"workers must be >= 1, got {workers}.")
+    max_in_flight = 2 * workers
+
+    print(f"[Diffraxia] Opening Eiger file: {h5_path}")
+
+    with h5py.File(h5_path, "r") as f:
+        if group_name not in f:
+            raise RuntimeError(f"Group {group_name!r} not found in file.")
+
+        group = f[group_name]
+        keys = list(list_frame_keys(group))
 
-    return arr
+        if nframes is not None:
+            keys = keys[:nframes]
+
+        print(f"[Diffraxia] Found {len(keys)} frame(s) in group {group_name!r}.")
+
+        # Resolve every frame to its data dataset once, so the frame loop
+        # does not repeat HDF5 name lookups. The shape and scalar metadata
+        # are the same for all frames of a run and are only read once;
+        # _decode_frame still checks every decoded frame's size.
+        payloads = [_select_payload_group(group[k]) for k in keys]
+        data_dsets = [p["data"] for p in payloads]
+        if payloads:
+            shape, decoder = _read_run_metadata(payloads)
+
+        pending = {}  # future -> (frame index, compressed-data buffer)
+        ready = {}  # frame index -> decoded image, waiting for its turn
+        next_idx = 0
+
+        # Buffers are recycled between frames instead of being allocated
+        # per frame. Both pools are only touched from the calling thread.
+        free_raw = []  # compressed-data buffers
+        free_img = []  # decoded-frame buffers
+
+        def collect() -> Iterator[tuple[int, int, np.ndarray]]:
+            # Wait for at least one decoded frame, then yield buffered
+            # frames as long as the next index is available, so frames
+            # come out strictly in order.
+            nonlocal next_idx
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                idx, raw_buf = pending.pop(fut)
+                free_raw.append(raw_buf)
+                ready[idx] = fut.result()
+            while next_idx in ready:
+                img = ready.pop(next_idx)
+                yield next_idx, len(keys), img
+                free_img.append(img)
+                next_idx += 1
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for idx, data_ds in enumerate(data_dsets):
+                raw_buf = free_raw.pop() if free_raw else None
+                out = free_img.pop() if free_img else None
+                raw_buf, raw = _read_raw(data_ds, raw_buf)
+                frame = (raw, shape, decoder)
+                fut = executor.submit(_decode_and_mask, frame, out)
+                pending[fut] = (idx, raw_buf)
+
+                # Bound memory: frames being decoded plus frames waiting
+                # to be consumed never exceed max_in_flight.
+                while len(pending) + len(ready) >= max_in_flight:
+                    yield from collect()
+
+            while pending:
+                yield from collect()
+
+
+# ---------------------------------------------------------------------------
+# Public API
+# ---------------------------------------------------------------------------
+
+def get_frame_array(
+    frame_group: h5py.Group,
+    raw_buf: Optional[np.ndarray] = None,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Decode a single Eiger frame into a 2D NumPy array.
+
+    The function automatically supports both:
+      * multi-channel layout: /data/<i>/difference/...
+      * flattened layout:     /data/<i>/{data, shape, dtype, ...}
+
+    Notes
+    -----
+    * We use a fixed NumPy dtype of uint32 for the decoded array, which
+      matches the typical Eiger bitstream (often reported as ``"<u4"``).
+    * The 'dtype' and 'elem_size' fields from the file are used only for
+      sanity checks and diagnostics, not for choosing the NumPy dtype.
+    * The returned array is a writable copy owned by the caller.
+    * When converting many frames, a uint8 ``raw_buf`` for the compressed
+      payload and a uint32 ``out`` array for the decoded frame can be
+      passed in and are reused instead of allocating new arrays.
+    """
+    _, frame = _read_frame_payload(frame_group, raw_buf)
+    return _decode_frame(*frame, out=out)
 
 
 def eiger_to_tiff(
@@ -185,10 +440,14 @@ def eiger_to_tiff(
     group_name: str = "data",
     output_folder: str = "tiff_out",
     nframes: Optional[int] = None,
+    workers: Optional[int] = None,
 ) -> None:
     """
     Convert an Eiger HDF5 file to a sequence of TIFF images.
 
+    Frames are decoded in parallel by a thread pool and written in frame
+    order. At most ``2 * workers`` frames are held in memory.
+
     Parameters
     ----------
     h5_path : str
@@ -202,40 +461,102 @@ def eiger_to_tiff(
     nframes : int, optional
         Maximum number of frames to convert. If None, all available
         frames under the given group are converted.
+    workers : int, optional
+        Number of decoding threads. If None, ``os.cpu_count()`` is used.
     """
     h5_path = os.path.abspath(h5_path)
     output_folder = os.path.abspath(output_folder)
     os.makedirs(output_folder, exist_ok=True)
 
-    print(f"[Diffraxia] Opening Eiger file: {h5_path}")
+    for idx, count, img in _iter_decoded_frames(h5_path, group_name, nframes, workers):
+        out_name = os.path.join(output_folder, f"frame_{idx:05d}.tiff")
+        with open(out_name, "wb", buffering=_TIFF_WRITE_BUFFER) as fh:
+            tifffile.imwrite(fh, img, photometric="minisblack", compression=None)
+            _drop_page_cache(fh)
+        print(f"[Diffraxia] {idx + 1}/{count} frame(s) → {out_name}")
 
-    with h5py.File(h5_path, "r") as f:
-        if group_name not in f:
-            raise RuntimeError(f"Group {group_name!r} not found in file.")
-
-        group = f[group_name]
-        keys = list(list_frame_keys(group))
+    print(f"[Diffraxia] Done. TIFF files saved to: {output_folder}")
 
-        if nframes is not None:
-            keys = keys[:nframes]
 
-        print(f"[Diffraxia] Found {len(keys)} frame(s) in group {group_name!r}.")
+def eiger_to_h5(
+    h5_path: str,
+    output_path: str = "frames.h5",
+    group_name: str = "data",
+    nframes: Optional[int] = None,
+    workers: Optional[int] = None,
+) -> None:
+    """
+    Convert an Eiger HDF5 file to a single 3D frame stack in HDF5.
 
-        for idx, k in enumerate(keys):
-            frame_group = group[k]
-            img = get_frame_array(frame_group)
+    Decoded frames are written to a ``(nframes, ny, nx)`` uint32 dataset
+    ``/data``, chunked one frame per chunk and compressed with
+    shuffle + LZF (both built into h5py). Compared to one TIFF per frame,
+    this avoids thousands of small files; the stack can be integrated
+    directly with :func:`diffraxia.integrate.integrate_h5_stack`.
 
-            # Replace saturation sentinel values (max of dtype) with 0.
-            # This avoids huge spikes in downstream integration.
-            if np.issubdtype(img.dtype, np.integer):
-                sentinel = np.iinfo(img.dtype).max
-                img = np.where(img == sentinel, 0, img)
+    The stack is written to ``<output_path>.tmp`` and renamed to
+    ``output_path`` once complete, so an existing output is only replaced
+    by a finished stack. Raises RuntimeError if ``output_path`` is the
+    input file or the group holds no frames.
 
-            img = np.asarray(img, dtype=np.uint32)
+    Parameters
+    ----------
+    h5_path : str
+        Path to the Eiger .h5 file.
+    output_path : str, optional
+        Path of the HDF5 file to create. Default is "frames.h5".
+    group_name : str, optional
+        Name of the top-level group that holds frame subgroups.
+        Typically "data". Default is "data".
+    nframes : int, optional
+        Maximum number of frames to convert. If None, all available
+        frames under the given group are converted.
+    workers : int, optional
+        Number of decoding threads. If None, ``os.cpu_count()`` is used.
+    """
+    h5_path = os.path.abspath(h5_path)
+    output_path = os.path.abspath(output_path)
+    if os.path.realpath(output_path) == os.path.realpath(h5_path) or (
+        os.path.exists(output_path) and os.path.samefile(output_path, h5_path)
+    ):
+        raise RuntimeError(
+            f"Output file {output_path} is the input file; choose a different output path."
+        )
 
-            out_name = os.path.join(output_folder, f"frame_{idx:05d}.tiff")
-            iio.imwrite(out_name, img)
+    # Open the input and decode the first frame before touching the output,
+    # so a missing input or group (or an empty one) leaves no partial file.
+    frames = _iter_decoded_frames(h5_path, group_name, nframes, workers)
+    try:
+        first = next(frames, None)
+        if first is None:
+            raise RuntimeError(f"No frames found in group {group_name!r}; nothing to write.")
 
-            print(f"[Diffraxia] {idx + 1}/{len(keys)} frame(s) → {out_name}")
+        parent_dir = os.path.dirname(output_path)
+        os.makedirs(parent_dir, exist_ok=True)
 
-    print(f"[Diffraxia] Done. TIFF files saved to: {output_folder}")
+        # Write to a temporary file next to the output and rename it into
+        # place once every frame is written.
+        tmp_path = f"{output_path}.tmp"
+        try:
+            with h5py.File(tmp_path, "w") as out:
+                _, count, img = first
+                stack = out.create_dataset(
+                    "data",
+                    shape=(count,) + img.shape,
+                    dtype=img.dtype,
+                    chunks=(1,) + img.shape,
+                    shuffle=True,
+                    compression="lzf",
+                )
+                for idx, count, img in itertools.chain([first], frames):
+                    stack[idx] = img
+                    print(f"[Diffraxia] {idx + 1}/{count} frame(s) → {output_path}:/data")
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    finally:
+        frames.close()
+
+    print(f"[Diffraxia] Done. Frame stack saved to: {output_path}")
@@ -1,15 +1,22 @@
 """
-Radial integration of diffraction TIFF images using a HEXRD instrument model.
+Radial integration of diffraction images (TIFF folders or HDF5 frame stacks)
+using a HEXRD instrument model.
 """
 
 import os
 import glob
-from typing import List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from typing import Callable, Iterator, List, Optional, Tuple
 
 import numpy as np
 import imageio.v3 as iio
 import h5py
 from hexrd import instrument
+from numba import get_num_threads, njit, prange
+
+
+OUTPUT_FORMATS = ("txt", "npy", "h5")
 
 
 def load_instrument(instr_file: str) -> instrument.HEDMInstrument:
@@ -31,6 +38,45 @@ def compute_tth_map(instr: instrument.HEDMInstrument) -> np.ndarray:
     return np.degrees(tth)
 
 
+# fastmath without the "nnan"/"ninf" flags: those would let LLVM assume
+# that 2θ is always finite and fold away the NaN rejection below.
+_FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+
+@njit(parallel=True, cache=True, fastmath=_FASTMATH)
+def _accumulate(img_flat, tth_flat, tth_min, tth_max, inv_width, nbins, nthreads, out):
+    """
+    Single-pass histogram kernel: add each pixel intensity to its 2θ bin.
+
+    Pixels are split into one contiguous block per thread (``nthreads`` is
+    passed in so the kernel stays cacheable), each thread fills its own
+    partial histogram, and the partials are reduced into ``out``.
+    Pixels with non-finite 2θ or outside [tth_min, tth_max] are skipped;
+    as with np.histogram, tth_max itself falls into the last bin.
+    """
+    npix = img_flat.size
+    block = (npix + nthreads - 1) // nthreads
+    partial = np.zeros((nthreads, nbins), dtype=np.float64)
+
+    for t in prange(nthreads):
+        start = t * block
+        stop = min(start + block, npix)
+        for i in range(start, stop):
+            tth = tth_flat[i]
+            if not (tth >= tth_min and tth <= tth_max):
+                continue
+            b = int((tth - tth_min) * inv_width)
+            if b >= nbins:
+                b = nbins - 1
+            partial[t, b] += np.float64(img_flat[i])
+
+    for b in prange(nbins):
+        acc = 0.0
+        for t in range(nthreads):
+            acc += partial[t, b]
+        out[b] = acc
+
+
 def radial_integrate(
     img: np.ndarray,
     tth_map_deg: np.ndarray,
@@ -41,17 +87,194 @@ def radial_integrate(
     """
     Accumulate pixel intensities into 2θ histogram bins (sum per bin).
     """
-    img_flat = img.ravel().astype(float)
+    _check_bins(tth_min, tth_max, nbins)
+
+    img_flat = img.ravel()
     tth_flat = tth_map_deg.ravel()
 
-    valid = np.isfinite(tth_flat)
-    img_flat = img_flat[valid]
-    tth_flat = tth_flat[valid]
+    sum_I = np.zeros(nbins, dtype=np.float64)
+    _accumulate(
+        img_flat,
+        tth_flat,
+        float(tth_min),
+        float(tth_max),
+        nbins / (tth_max - tth_min),
+        nbins,
+        get_num_threads(),
+        sum_I,
+    )
+
+    return _bin_centers(tth_min, tth_max, nbins), sum_I
+
+
+def _check_bins(tth_min: float, tth_max: float, nbins: int) -> None:
+    """
+    Validate the 2θ binning parameters.
+
+    Bin indices are computed directly from ``(tth - tth_min) * nbins /
+    (tth_max - tth_min)``, which is only meaningful for a non-empty range
+    and at least one bin (np.histogram used to reject such input itself).
+    """
+    if nbins < 1:
+        raise ValueError(f"nbins must be >= 1, got {nbins}.")
+    if not tth_max > tth_min:
+        raise ValueError(
+            f"tth_max must be greater than tth_min, got tth_min={tth_min}, tth_max={tth_max}."
+        )
+
 
+def _bin_centers(tth_min: float, tth_max: float, nbins: int) -> np.ndarray:
+    """Return the centers of ``nbins`` uniform 2θ bins spanning [tth_min, tth_max]."""
     edges = np.linspace(tth_min, tth_max, nbins + 1)
-    sum_I, _ = np.histogram(tth_flat, bins=edges, weights=img_flat)
-    tth_centers = 0.5 * (edges[:-1] + edges[1:])
-    return tth_centers, sum_I
+    return 0.5 * (edges[:-1] + edges[1:])
+
+
+def _build_bin_lut(
+    tth_map_deg: np.ndarray,
+    tth_min: float,
+    tth_max: float,
+    nbins: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Precompute the 2θ binning of the detector as a pixel permutation.
+
+    The detector geometry is fixed for a whole folder of frames, so the
+    bin lookup only needs to be done once. Pixels whose 2θ is finite and
+    inside [tth_min, tth_max] are sorted by bin, so that each frame can be
+    reduced with a single streaming np.add.reduceat instead of a scatter.
+    Binning matches :func:`radial_integrate`.
+
+    Returns
+    -------
+    pixel_order : np.ndarray
+        Flat indices of the valid pixels, sorted by 2θ bin.
+    seg_starts : np.ndarray
+        Start offset in ``pixel_order`` of each non-empty bin.
+    seg_bins : np.ndarray
+        Bin index of each of those segments.
+    """
+    _check_bins(tth_min, tth_max, nbins)
+
+    tth_flat = tth_map_deg.ravel()
+    # NaN compares False against both bounds (and ±inf lies outside any
+    # finite range), so the range test alone already drops non-finite 2θ;
+    # no separate np.isfinite pass over the map is needed.
+    valid = tth_flat >= tth_min
+    valid &= tth_flat <= tth_max
+    valid_idx = np.flatnonzero(valid)
+
+    scale = nbins / (tth_max - tth_min)
+    bin_idx = ((tth_flat[valid_idx] - tth_min) * scale).astype(np.int32)
+    # tth_max itself belongs to the last bin, as with np.histogram
+    np.minimum(bin_idx, nbins - 1, out=bin_idx)
+
+    perm = np.argsort(bin_idx, kind="stable")
+    pixel_order = valid_idx[perm]
+    bins_sorted = bin_idx[perm]
+
+    # np.add.reduceat cannot express empty segments, so only the bins that
+    # actually receive pixels get a segment.
+    seg_bins, seg_starts = np.unique(bins_sorted, return_index=True)
+    return pixel_order, seg_starts, seg_bins
+
+
+def _integrate_with_lut(
+    vals: np.ndarray,
+    seg_starts: np.ndarray,
+    seg_bins: np.ndarray,
+    nbins: int,
+) -> np.ndarray:
+    """
+    Sum pixel intensities per 2θ bin using a LUT from :func:`_build_bin_lut`.
+
+    ``vals`` has shape ``(nframes, npix_valid)`` and holds the intensities
+    of each frame gathered in ``pixel_order``. All frames are reduced by a
+    single np.add.reduceat call; returns an ``(nframes, nbins)`` array.
+    """
+    sum_I = np.zeros((vals.shape[0], nbins), dtype=np.float64)
+    if vals.shape[1]:
+        # Keep the gathered intensities in their native (uint32) dtype and
+        # only accumulate in float64, instead of materializing a float copy.
+        sum_I[:, seg_bins] = np.add.reduceat(vals, seg_starts, axis=1, dtype=np.float64)
+    return sum_I
+
+
+def _load_tiff_batch(tiff_paths: List[str]) -> Iterator[Tuple[str, np.ndarray]]:
+    """Yield ``(label, image)`` for each TIFF file of a batch."""
+    for tiff_path in tiff_paths:
+        yield tiff_path, iio.imread(tiff_path)
+
+
+def _load_h5_batch(batch: Tuple[str, str, int, int]) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Yield ``(label, image)`` for frames ``start:stop`` of a 3D HDF5 stack.
+
+    ``batch`` is ``(h5_path, dataset, start, stop)``. The file is opened per
+    batch so that batches can be read from worker processes.
+    """
+    h5_path, dataset, start, stop = batch
+    with h5py.File(h5_path, "r") as h5:
+        stack = h5[dataset]
+        for i in range(start, stop):
+            yield f"{h5_path}:{dataset}[{i}]", stack[i]
+
+
+def _integrate_batch(batch, state: dict) -> np.ndarray:
+    """
+    Load a batch of frames and integrate them with the LUT in ``state``.
+
+    ``state`` holds the batch loader (``load_batch``), the detector
+    ``shape``, the LUT arrays from :func:`_build_bin_lut`, ``nbins``, and
+    a ``buffer`` for gathered pixels that is (re)allocated on demand and
+    kept for the next call.
+    """
+    pixel_order = state["pixel_order"]
+    buf = state["buffer"]
+
+    nframes = 0
+    for j, (label, img) in enumerate(state["load_batch"](batch)):
+        if img.shape != state["shape"]:
+            raise RuntimeError(
+                f"Image shape {img.shape} of {label} does not match "
+                f"detector geometry {state['shape']}"
+            )
+        if buf is None or buf.shape[0] < state["batch_size"]:
+            buf = np.empty((state["batch_size"], pixel_order.size), dtype=img.dtype)
+        else:
+            # Mixed-dtype inputs are rare; promote the buffer only if this
+            # frame's dtype does not fit, so intensities are never narrowed.
+            promoted = np.result_type(buf.dtype, img.dtype)
+            if promoted != buf.dtype:
+                buf = buf.astype(promoted)
+        state["buffer"] = buf
+
+        if img.dtype == buf.dtype:
+            # mode="clip" lets np.take write straight into the buffer row
+            # (mode="raise" buffers); the indices are in range by construction.
+            np.take(img.ravel(), pixel_order, out=buf[j], mode="clip")
+        else:
+            # np.take(out=...) refuses to cast, so gather and upcast on assignment
+            buf[j] = img.ravel()[pixel_order]
+        nframes += 1
+
+    return _integrate_with_lut(
+        buf[:nframes], state["seg_starts"], state["seg_bins"], state["nbins"]
+    )
+
+
+# Integration state of a worker process, set up once by _init_worker so the
+# (large) LUT arrays are not pickled with every task.
+_WORKER_STATE: dict = {}
+
+
+def _init_worker(state: dict) -> None:
+    """Process-pool initializer: install the integration state."""
+    _WORKER_STATE.update(state)
+
+
+def _integrate_batch_in_worker(batch) -> np.ndarray:
+    """Process-pool task: integrate one batch with the worker's state."""
+    return _integrate_batch(batch, _WORKER_STATE)
 
 
 def collect_tiff_files(folder: str, pattern: str = "*.tiff,*.tif") -> List[str]:
@@ -66,6 +289,202 @@ def collect_tiff_files(folder: str, pattern: str = "*.tiff,*.tif") -> List[str]:
     return sorted(files)
 
 
+def _output_paths(output_format: str, prefix: str, names: List[str]) -> List[str]:
+    """
+    Return the files written for ``output_format``: one text file per
+    frame for ``txt``, otherwise the single-file outputs described in
+    :func:`_open_output_rows` (for ``npy``: tth first, then I_sum).
+    """
+    if output_format == "h5":
+        return [f"{prefix}.h5"]
+    if output_format == "npy":
+        return [f"{prefix}_tth.npy", f"{prefix}_I_sum.npy"]
+    return [f"{prefix}_{base}.txt" for base in names]
+
+
+def _check_outputs_not_inputs(output_paths: List[str], input_paths: List[str]) -> None:
+    """
+    Refuse to run if any output file is one of the input files.
+
+    Outputs are opened for writing before the inputs are read, so such a
+    collision would truncate the input. Paths are compared after resolving
+    symlinks, and existing files additionally by device/inode (like
+    os.path.samefile) to catch hard links.
+    """
+    real_inputs = {os.path.realpath(p) for p in input_paths}
+    input_ids = set()
+    for path in input_paths:
+        if os.path.exists(path):
+            st = os.stat(path)
+            input_ids.add((st.st_dev, st.st_ino))
+
+    for path in output_paths:
+        same = os.path.realpath(path) in real_inputs
+        if not same and os.path.exists(path):
+            st = os.stat(path)
+            same = (st.st_dev, st.st_ino) in input_ids
+        if same:
+            raise RuntimeError(
+                f"Output file {path} is also an input file; choose a different "
+                "--output-prefix or --output-format."
+            )
+
+
+def _open_output_rows(
+    stack: ExitStack,
+    output_format: str,
+    output_paths: List[str],
+    tth: np.ndarray,
+    names: List[str],
+) -> Optional[np.ndarray]:
+    """
+    Create the on-disk ``(nframes, nbins)`` intensity array for the
+    single-file output formats and return it for row-wise filling.
+
+    * ``h5``:  <prefix>.h5 with datasets ``tth``, ``I_sum`` and ``frames``
+      (the frame names, in row order). ``I_sum`` is chunked per frame
+      and LZF-compressed.
+    * ``npy``: <prefix>_tth.npy and a memory-mapped <prefix>_I_sum.npy.
+
+    ``output_paths`` comes from :func:`_output_paths`. Returns None for
+    ``txt``, which writes one file per frame instead. Files are
+    closed/flushed through ``stack``.
+    """
+    shape = (len(names), tth.size)
+
+    if output_format == "h5":
+        (h5_path,) = output_paths
+        out = stack.enter_context(h5py.File(h5_path, "w"))
+        out.create_dataset("tth", data=tth)
+        out.create_dataset("frames", data=names, dtype=h5py.string_dtype())
+        return out.create_dataset(
+            "I_sum",
+            shape=shape,
+            dtype="f8",
+            chunks=(1, tth.size),
+            compression="lzf",
+        )
+
+    if output_format == "npy":
+        tth_path, rows_path = output_paths
+        np.save(tth_path, tth)
+        rows = np.lib.format.open_memmap(rows_path, mode="w+", dtype="f8", shape=shape)
+        stack.callback(rows.flush)
+        return rows
+
+    return None
+
+
+def _check_integration_options(batch_size: int, output_format: str, workers: int) -> None:
+    """Validate the options shared by the integration entry points."""
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be >= 1, got {batch_size}.")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"Unknown output_format {output_format!r}, expected one of {OUTPUT_FORMATS}."
+        )
+    if workers < 1:
+        raise ValueError(f"workers must be >= 1, got {workers}.")
+
+
+def _integrate_frames(
+    instr_file: str,
+    frame_shape: Tuple[int, ...],
+    names: List[str],
+    input_paths: List[str],
+    batches: list,
+    load_batch: Callable,
+    tth_min: float,
+    tth_max: float,
+    nbins: int,
+    output_prefix: str,
+    batch_size: int,
+    output_format: str,
+    workers: int,
+) -> None:
+    """
+    Integrate a sequence of frames and write the results.
+
+    ``names`` has one entry per frame (used for output file names),
+    ``input_paths`` lists the files the frames are read from, and
+    ``batches`` splits the frames into groups of at most ``batch_size``
+    that ``load_batch`` turns into ``(label, image)`` pairs.
+    """
+    instr = load_instrument(instr_file)
+    tth_map_deg = compute_tth_map(instr)
+
+    if frame_shape != tth_map_deg.shape:
+        raise RuntimeError(
+            f"Image shape {frame_shape} does not match detector geometry {tth_map_deg.shape}"
+        )
+
+    # The geometry is shared by all frames: bin every pixel once up front.
+    pixel_order, seg_starts, seg_bins = _build_bin_lut(tth_map_deg, tth_min, tth_max, nbins)
+    tth = _bin_centers(tth_min, tth_max, nbins)
+
+    # Normalize and prepare the output prefix
+    # 1) If it has a directory, make it absolute
+    # 2) Strip any trailing underscores so we do not get double "__"
+    raw_prefix = output_prefix
+    if os.path.dirname(raw_prefix):
+        raw_prefix = os.path.abspath(raw_prefix)
+    prefix = raw_prefix.rstrip("_")
+
+    output_paths = _output_paths(output_format, prefix, names)
+    _check_outputs_not_inputs(output_paths, input_paths)
+
+    # Create output directory if needed
+    parent_dir = os.path.dirname(prefix)
+    if parent_dir:
+        os.makedirs(parent_dir, exist_ok=True)
+
+    state = {
+        "load_batch": load_batch,
+        "shape": tth_map_deg.shape,
+        "pixel_order": pixel_order,
+        "seg_starts": seg_starts,
+        "seg_bins": seg_bins,
+        "nbins": nbins,
+        "batch_size": min(batch_size, len(names)),
+        "buffer": None,
+    }
+    workers = min(workers, len(batches))
+
+    with ExitStack() as stack:
+        out_rows = _open_output_rows(stack, output_format, output_paths, tth, names)
+
+        if workers > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=_init_worker,
+                    initargs=(state,),
+                )
+            )
+            results = executor.map(_integrate_batch_in_worker, batches)
+        else:
+            results = (_integrate_batch(batch, state) for batch in batches)
+
+        done = 0
+        for I_sums in results:
+            if out_rows is not None:
+                out_rows[done : done + len(I_sums)] = I_sums
+
+            for I_sum in I_sums:
+                base = names[done]
+                done += 1
+                print(f"[Diffraxia] [{done}/{len(names)}] Integrated {base}")
+
+                if out_rows is None:
+                    np.savetxt(
+                        output_paths[done - 1],
+                        np.column_stack([tth, I_sum]),
+                        header="2theta_deg\tIntensity_sum",
+                    )
+
+    print("[Diffraxia] Integration completed.")
+
+
 def integrate_tiff_folder(
     instr_file: str,
     tiff_folder: str,
@@ -74,16 +493,35 @@ def integrate_tiff_folder(
     nbins: int = 2000,
     pattern: str = "*.tiff,*.tif",
     output_prefix: str = "pattern",
+    batch_size: int = 16,
+    output_format: str = "txt",
+    workers: int = 1,
 ) -> None:
     """
     Perform independent radial integration for all TIFF files in a folder.
 
-    For each TIFF file, a corresponding text file is generated:
+    With output_format="txt", a corresponding text file is generated for
+    each TIFF file:
         <output_prefix>_<tiff_basename>.txt
 
+    With "h5" or "npy", all frames are written to a single file instead
+    (one row per TIFF file, in sorted file order):
+        <output_prefix>.h5
+        <output_prefix>_tth.npy, <output_prefix>_I_sum.npy
+
     If output_prefix includes a directory component, that directory
     is created automatically.
+
+    Frames are integrated ``batch_size`` at a time. The batch buffer holds
+    the in-range pixels of each frame in its native dtype, i.e. roughly
+    ``batch_size * 4`` bytes per detector pixel for uint32 images.
+
+    With ``workers > 1``, batches are integrated in parallel by a pool of
+    worker processes, each holding its own copy of the LUT and one batch
+    buffer. Outputs are still written by this process, in file order.
     """
+    _check_integration_options(batch_size, output_format, workers)
+
     instr_file = os.path.abspath(instr_file)
     tiff_folder = os.path.abspath(tiff_folder)
 
@@ -96,47 +534,90 @@ def integrate_tiff_folder(
 
     print(f"[Diffraxia] Found {len(tiff_files)} TIFF file(s).")
 
-    instr = load_instrument(instr_file)
-    tth_map_deg = compute_tth_map(instr)
-
     test_img = iio.imread(tiff_files[0])
-    if test_img.shape != tth_map_deg.shape:
-        raise RuntimeError(
-            f"Image shape {test_img.shape} does not match detector geometry {tth_map_deg.shape}"
-        )
+    names = [os.path.splitext(os.path.basename(p))[0] for p in tiff_files]
+    batches = [tiff_files[i : i + batch_size] for i in range(0, len(tiff_files), batch_size)]
 
-    # Normalize and prepare the output prefix
-    # 1) If it has a directory, make it absolute
-    # 2) Strip any trailing underscores so we do not get double "__"
-    raw_prefix = output_prefix
-    if os.path.dirname(raw_prefix):
-        raw_prefix = os.path.abspath(raw_prefix)
-    prefix = raw_prefix.rstrip("_")
+    _integrate_frames(
+        instr_file,
+        test_img.shape,
+        names,
+        tiff_files,
+        batches,
+        _load_tiff_batch,
+        tth_min,
+        tth_max,
+        nbins,
+        output_prefix,
+        batch_size,
+        output_format,
+        workers,
+    )
 
-    # Create output directory if needed
-    parent_dir = os.path.dirname(prefix)
-    if parent_dir:
-        os.makedirs(parent_dir, exist_ok=True)
 
-    for idx, tiff_path in enumerate(tiff_files, start=1):
-        base = os.path.splitext(os.path.basename(tiff_path))[0]
-        print(f"[Diffraxia] [{idx}/{len(tiff_files)}] Integrating {base} ...")
+def integrate_h5_stack(
+    instr_file: str,
+    h5_path: str,
+    dataset: str = "data",
+    tth_min: float = 0.0,
+    tth_max: float = 20.0,
+    nbins: int = 2000,
+    output_prefix: str = "pattern",
+    batch_size: int = 16,
+    output_format: str = "txt",
+    workers: int = 1,
+) -> None:
+    """
+    Perform independent radial integration for every frame of a 3D
+    ``(nframes, ny, nx)`` HDF5 dataset, e.g. one written by
+    :func:`diffraxia.eiger.eiger_to_h5`.
+
+    This reads frames straight from the stack instead of going through
+    one TIFF file per frame. Frame ``i`` is named ``frame_<i:05d>``, as
+    in eiger_to_tiff, so outputs match those of the TIFF workflow; see
+    :func:`integrate_tiff_folder` for the output formats and options.
+    """
+    _check_integration_options(batch_size, output_format, workers)
 
-        img = iio.imread(tiff_path)
+    instr_file = os.path.abspath(instr_file)
+    h5_path = os.path.abspath(h5_path)
 
-        tth, I_sum = radial_integrate(
-            img,
-            tth_map_deg,
-            tth_min,
-            tth_max,
-            nbins,
-        )
+    print(f"[Diffraxia] Instrument file : {instr_file}")
+    print(f"[Diffraxia] Frame stack     : {h5_path}:{dataset}")
 
-        outname = f"{prefix}_{base}.txt"
-        np.savetxt(
-            outname,
-            np.column_stack([tth, I_sum]),
-            header="2theta_deg\tIntensity_sum",
+    with h5py.File(h5_path, "r") as h5:
+        if dataset not in h5:
+            raise RuntimeError(f"Dataset {dataset!r} not found in {h5_path}.")
+        stack_shape = h5[dataset].shape
+
+    if len(stack_shape) != 3:
+        raise RuntimeError(
+            f"Expected a 3D (nframes, ny, nx) dataset, got shape {stack_shape}."
         )
+    nframes = stack_shape[0]
+    if not nframes:
+        raise RuntimeError("No frames found in the specified dataset.")
 
-    print("[Diffraxia] Integration completed.")
+    print(f"[Diffraxia] Found {nframes} frame(s).")
+
+    names = [f"frame_{i:05d}" for i in range(nframes)]
+    batches = [
+        (h5_path, dataset, i, min(i + batch_size, nframes))
+        for i in range(0, nframes, batch_size)
+    ]
+
+    _integrate_frames(
+        instr_file,
+        stack_shape[1:],
+        names,
+        [h5_path],
+        batches,
+        _load_h5_batch,
+        tth_min,
+        tth_max,
+        nbins,
+        output_prefix,
+        batch_size,
+        output_format,
+        workers,
+    )